@@ -4,27 +4,48 @@ Automatically identifies junctions with traffic lights and updates config.yaml
 """
 
 import yaml
-import traci
 import sys
 import os
+import json
+import hashlib
+import xml.etree.ElementTree as ET
 
-def discover_junctions(config_file='config.yaml'):
+# libyaml-backed loader/dumper when available (pure-Python fallback)
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+# libsumo runs SUMO in-process (no TraCI socket); discovery is always headless
+try:
+    import libsumo as traci
+except ImportError:
+    import traci
+
+def _cache_path(sumo_config):
     """
-    Discovers all traffic-light-controlled junctions in the SUMO network
-    and updates the config file with the list of controlled junctions.
+    Returns the discovery cache file for a SUMO scenario, keyed by a hash of
+    the .sumocfg and the network file it references.
     """
+    sumo_dir = os.path.dirname(sumo_config)
+    digest = hashlib.sha1()
     
-    # Load configuration
-    with open(config_file, 'r') as f:
-        config = yaml.safe_load(f)
-    
-    sumo_config = config['sumo']['config_file']
+    with open(sumo_config, 'rb') as f:
+        cfg_bytes = f.read()
+    digest.update(cfg_bytes)
     
-    print("="*70)
-    print("JUNCTION DISCOVERY TOOL")
-    print("="*70)
-    print(f"\nSUMO Config: {sumo_config}\n")
+    net_file = ET.fromstring(cfg_bytes).find('.//net-file')
+    if net_file is not None:
+        with open(os.path.join(sumo_dir, net_file.get('value')), 'rb') as f:
+            digest.update(f.read())
     
+    return os.path.join(sumo_dir, f".junction_cache_{digest.hexdigest()[:16]}.json")
+
+def _discover_with_sumo(sumo_config):
+    """
+    Starts a headless SUMO instance and enumerates traffic-light junctions.
+    Returns (controlled_junctions, max_roads).
+    """
     # Check if SUMO_HOME is set
     if 'SUMO_HOME' not in os.environ:
         print("❌ Error: SUMO_HOME environment variable not set.")
@@ -50,17 +71,9 @@ def discover_junctions(config_file='config.yaml'):
         
         for jid in all_junctions:
             try:
-                # Get controlled lanes for this junction
+                # Unique incoming road IDs (lane format: "edge_id_lane_index")
                 controlled_lanes = traci.trafficlight.getControlledLanes(jid)
-                
-                # Extract unique road IDs (incoming roads)
-                incoming_roads = set()
-                for lane_id in controlled_lanes:
-                    # Lane format: "edge_id_lane_index"
-                    road_id = '_'.join(lane_id.split('_')[:-1])
-                    incoming_roads.add(road_id)
-                
-                num_roads = len(incoming_roads)
+                num_roads = len({lane_id.rsplit('_', 1)[0] for lane_id in controlled_lanes})
                 max_roads = max(max_roads, num_roads)
                 
                 controlled_junctions.append(jid)
@@ -71,18 +84,7 @@ def discover_junctions(config_file='config.yaml'):
                 continue
         
         print("-"*70)
-        print(f"\nTotal Controllable Junctions: {len(controlled_junctions)}")
-        print(f"Maximum Roads at Any Junction: {max_roads}")
-        
-        # Update config file
-        config['system']['controlled_junctions'] = controlled_junctions
-        config['system']['max_roads'] = max_roads
-        
-        with open(config_file, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False, sort_keys=False)
-        
-        print(f"\n✓ Config file updated: {config_file}")
-        print("="*70)
+        return controlled_junctions, max_roads
         
     except Exception as e:
         print(f"\n❌ Error during discovery: {e}")
@@ -91,5 +93,56 @@ def discover_junctions(config_file='config.yaml'):
     finally:
         traci.close()
 
+def discover_junctions(config_file='config.yaml'):
+    """
+    Discovers all traffic-light-controlled junctions in the SUMO network
+    and updates the config file with the list of controlled junctions.
+    Results are cached per network, so SUMO only starts when it changed.
+    """
+    
+    # Load configuration
+    with open(config_file, 'r') as f:
+        config = yaml.load(f, Loader=SafeLoader)
+    
+    sumo_config = config['sumo']['config_file']
+    
+    print("="*70)
+    print("JUNCTION DISCOVERY TOOL")
+    print("="*70)
+    print(f"\nSUMO Config: {sumo_config}\n")
+    
+    cache_path = _cache_path(sumo_config)
+    
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        controlled_junctions = cached['controlled_junctions']
+        max_roads = cached['max_roads']
+        print(f"✓ Network unchanged, using cached discovery: {cache_path}")
+    else:
+        controlled_junctions, max_roads = _discover_with_sumo(sumo_config)
+        with open(cache_path, 'w') as f:
+            json.dump({'controlled_junctions': controlled_junctions, 'max_roads': max_roads}, f)
+    
+    print(f"\nTotal Controllable Junctions: {len(controlled_junctions)}")
+    print(f"Maximum Roads at Any Junction: {max_roads}")
+    
+    # Skip the rewrite when the config already matches
+    if (config['system'].get('controlled_junctions') == controlled_junctions and
+            config['system'].get('max_roads') == max_roads):
+        print(f"\n✓ Config unchanged, skipping write: {config_file}")
+        print("="*70)
+        return
+    
+    # Update config file
+    config['system']['controlled_junctions'] = controlled_junctions
+    config['system']['max_roads'] = max_roads
+    
+    with open(config_file, 'w') as f:
+        yaml.dump(config, f, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
+    
+    print(f"\n✓ Config file updated: {config_file}")
+    print("="*70)
+
 if __name__ == '__main__':
     discover_junctions()
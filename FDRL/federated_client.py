@@ -4,18 +4,38 @@ Each client trains independently on its junction and sends updates to server
 """
 
 import socket
-import pickle
 import torch
 import numpy as np
 import time
-import traci
-from torch.distributions import Categorical
+from functools import partial
+from typing import Optional, Tuple
+from torch.nn.utils import parameters_to_vector
 from ppo_agent import PPOAgent, Memory
+from federated_protocol import pack_update, decode_weights, copy_into_parameters, pack_hello, configure_socket, send_frame, recv_exact, update_size, WIRE_DTYPE, WIRE_ITEMSIZE
 from sumo_simulator import SumoSimulator
+from vec_env import SumoVecEnv
 from lightning.fabric import Fabric
 
+@torch.jit.script
+def masked_sample(logits: torch.Tensor, pad_mask: Optional[torch.Tensor]) -> Tuple[int, float]:
+    """Samples from the masked softmax policy; returns (action, log_prob) as Python scalars."""
+    if pad_mask is not None:
+        logits = logits.masked_fill(pad_mask, float('-inf'))
+    log_probs = torch.log_softmax(logits, dim=-1)
+    action = int(torch.multinomial(log_probs.exp(), 1))
+    return action, float(log_probs[action])
+
+@torch.jit.script
+def masked_sample_batch(logits: torch.Tensor, pad_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """masked_sample over a (num_envs, action_dim) batch; returns (actions, log_probs) tensors."""
+    if pad_mask is not None:
+        logits = logits.masked_fill(pad_mask, float('-inf'))
+    log_probs = torch.log_softmax(logits, dim=-1)
+    actions = torch.multinomial(log_probs.exp(), 1)
+    return actions.squeeze(1), log_probs.gather(1, actions).squeeze(1)
+
 class FederatedClient:
-    def __init__(self, junction_info, config):
+    def __init__(self, junction_info, config, shared_weights=None, shared_upload=None, topology=None):
         self.junction_id = junction_info['id']
         self.incoming_roads = junction_info['incoming_roads']
         self.actual_action_dim = len(self.incoming_roads)
@@ -26,6 +46,14 @@ class FederatedClient:
         self.action_dim = self.max_roads
         self.config = config
         
+        # Flat global weights and this client's upload slot in shared memory
+        # (set when co-located with the server)
+        self.shared_weights = shared_weights
+        self.shared_upload = shared_upload
+        
+        # Network data discovered once by the parent (see SumoSimulator.topology)
+        self.topology = topology
+        
         print(f"\n{'='*50}")
         print(f"CLIENT: {self.junction_id[:30]}")
         print(f"{'='*50}")
@@ -33,17 +61,53 @@ class FederatedClient:
         print(f"Model Dims: {self.action_dim} actions (universal)")
         print(f"{'='*50}\n")
         
-        # Initialize Fabric and agent
-        self.fabric = Fabric(accelerator="auto", devices=1)
+        # Initialize Fabric and agent (the actor is tiny: CPU avoids per-step H2D/D2H copies)
+        # (client_precision 'bf16-mixed' autocasts the PPO update on capable devices;
+        # parameters must stay float32 for the rollout buffers and weight exchange)
+        precision = str(config['fdrl'].get('client_precision', '32-true'))
+        if precision not in ('32', '32-true') and not precision.endswith('-mixed'):
+            raise ValueError(f"Unsupported fdrl.client_precision '{precision}': use '32-true' or a '*-mixed' setting")
+        self.fabric = Fabric(accelerator=config['fdrl'].get('client_accelerator', 'auto'), devices=1,
+                             precision=precision)
         self.fabric.launch()
         
         self.agent = PPOAgent(self.state_dim, self.action_dim, config, fabric=self.fabric)
-        self.memory = Memory()
+        
+        # Parallel simulations feeding this client's learner (stepped in lockstep)
+        self.num_envs = config['fdrl'].get('num_envs', 1)
+        self.memory = Memory(config['fdrl']['K'] * self.num_envs, self.state_dim,
+                             pin_memory=self.fabric.device.type == 'cuda', num_envs=self.num_envs)
+        
+        # Persistent buffers for action selection (reused every step)
+        # Padding mask: True for padded actions (beyond actual roads);
+        # None when the junction uses every action slot
+        self._pad_mask = None
+        if self.actual_action_dim < self.action_dim:
+            self._pad_mask = torch.ones(self.action_dim, dtype=torch.bool, device=self.fabric.device)
+            self._pad_mask[:self.actual_action_dim] = False
+        self._state_buf = torch.empty(self.state_dim, device=self.fabric.device)
+        if self.num_envs > 1:
+            self._states_buf = torch.empty((self.num_envs, self.state_dim), device=self.fabric.device)
+        
+        # TorchScript copy of the sampling network (shares the actor's parameters;
+        # rollouts finish before each update, so no separate old policy is kept)
+        actor = getattr(self.agent.actor, 'module', self.agent.actor)
+        self._policy_net = torch.jit.script(actor.network).eval()
+        
+        # Host-side upload buffer in wire precision (pinned for async D2H on GPU)
+        n_params = sum(p.numel() for p in self.agent.actor.parameters())
+        self._pinned_send = self.fabric.device.type == 'cuda'
+        self._send_buf = torch.empty(n_params, dtype=WIRE_DTYPE, pin_memory=self._pinned_send)
+        
+        # Reusable wire buffers (packed upload, incoming broadcast)
+        self._upload_buf = bytearray(update_size(n_params))
+        self._broadcast_buf = bytearray(n_params * WIRE_ITEMSIZE)
         
         # Server connection setup
         self.server_host = config['system']['server_host']
         self.server_port = config['system']['server_port']
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        configure_socket(self.socket)
     
     def connect_to_server(self):
         """Connect to federated server with retry logic."""
@@ -56,12 +120,7 @@ class FederatedClient:
                 print(f"✓ Client {self.junction_id[:20]} connected")
                 
                 # Send metadata to server
-                meta_data = {
-                    'junction_id': self.junction_id,
-                    'state_dim': self.state_dim,
-                    'action_dim': self.actual_action_dim
-                }
-                self.socket.sendall(pickle.dumps(meta_data))
+                self.socket.sendall(pack_hello(self.junction_id, self.state_dim, self.actual_action_dim))
                 return
                 
             except ConnectionRefusedError:
@@ -76,120 +135,181 @@ class FederatedClient:
         Select action using universal model with action masking.
         Masks out padded actions (beyond actual number of roads).
         """
-        state_tensor = torch.FloatTensor(state).to(self.fabric.device)
+        state_tensor = self._state_buf.copy_(torch.from_numpy(np.asarray(state, dtype=np.float32)))
+        
+        with torch.inference_mode():
+            logits = self._policy_net(state_tensor)
+            
+            # Padded actions get zero probability
+            return masked_sample(logits, self._pad_mask)
+    
+    def select_actions_batch(self, states):
+        """
+        Batched select_action_with_masking over a (num_envs, state_dim) array.
+        Returns (actions, log_probs) as NumPy arrays.
+        """
+        states_tensor = self._states_buf.copy_(torch.from_numpy(states))
+        
+        with torch.inference_mode():
+            logits = self._policy_net(states_tensor)
+            actions, log_probs = masked_sample_batch(logits, self._pad_mask)
+            return actions.cpu().numpy(), log_probs.cpu().numpy()
+    
+    def _rollout(self, sim, epoch):
+        """Collects up to K steps from one simulation. Returns (cumulative_reward, steps)."""
+        # Loop constants and bound methods (looked up once, not per step)
+        jid = self.junction_id
+        K = self.config['fdrl']['K']
+        yellow_time = self.config['fdrl']['yellow_time']
+        green_time = self.config['fdrl']['green_time']
+        select_action = self.select_action_with_masking
+        set_phase = sim.set_phase
+        observe = sim.observe
+        min_expected_vehicles = sim.min_expected_vehicles
+        push = self.memory.push
+        
+        cumulative_reward = 0
+        steps_completed = 0
+        
+        # Initial state; afterwards each observe() yields the reward of the
+        # action just taken and the state for the next decision in one sweep
+        state = sim.get_state(jid)
         
-        with torch.no_grad():
-            action_probs = self.agent.actor_old(state_tensor)
+        for k_step in range(K):
+            # Check if simulation still has vehicles
+            if min_expected_vehicles() == 0:
+                print(f"  ⚠️  No more vehicles at epoch {epoch+1}, step {k_step}")
+                break
+            
+            # Select action
+            action, log_prob = select_action(state)
             
-            # Create mask: 1 for valid actions, 0 for padded
-            mask = torch.zeros(self.action_dim, device=self.fabric.device)
-            mask[:self.actual_action_dim] = 1.0
+            # Execute action
+            set_phase(jid, action, yellow_time, green_time)
             
-            # Apply mask and renormalize
-            masked_probs = action_probs * mask
-            masked_probs = masked_probs / (masked_probs.sum() + 1e-10)
+            # Get reward (and next state)
+            next_state, reward = observe(jid)
             
-            dist = Categorical(masked_probs)
-            action = dist.sample()
-            action_log_prob = dist.log_prob(action)
+            # Store experience
+            push(state, action, log_prob, reward, False)
+            state = next_state
+            cumulative_reward += reward
+            steps_completed += 1
+        
+        return cumulative_reward, steps_completed
+    
+    def _rollout_vectorized(self, envs, epoch):
+        """
+        Collects up to K lockstep steps from every environment of envs.
+        Returns (cumulative_reward averaged over envs, steps per env).
+        """
+        K = self.config['fdrl']['K']
+        select_actions = self.select_actions_batch
+        step = envs.step
+        push_batch = self.memory.push_batch
+        not_terminal = np.zeros(self.num_envs, dtype=np.bool_)
+        
+        states = np.empty((self.num_envs, self.state_dim), dtype=np.float32)
+        next_states = np.empty_like(states)
+        rewards = np.empty(self.num_envs, dtype=np.float32)
+        
+        cumulative_reward = 0.0
+        steps_completed = 0
+        remaining = envs.get_states(states)
+        
+        for k_step in range(K):
+            # Stop as soon as any simulation runs out of vehicles
+            if remaining == 0:
+                print(f"  ⚠️  No more vehicles at epoch {epoch+1}, step {k_step}")
+                break
             
-            return action.item(), action_log_prob.item()
+            actions, log_probs = select_actions(states)
+            remaining = step(actions.tolist(), next_states, rewards)
+            
+            push_batch(states, actions, log_probs, rewards, not_terminal)
+            states, next_states = next_states, states
+            cumulative_reward += float(rewards.mean())
+            steps_completed += 1
+        
+        return cumulative_reward, steps_completed
     
     def run(self):
         """Main training loop for federated client."""
         self.connect_to_server()
         
-        # Initialize simulator ONCE before all epochs
-        sim = SumoSimulator(
-            self.config['sumo']['config_file'],
-            self.config,
-            step_length=self.config['sumo']['step_length'],
-            gui=False
-        )
+        # Initialize simulator(s) ONCE before all epochs
+        if self.num_envs > 1:
+            envs = SumoVecEnv(self.num_envs, self.junction_id, self.config, self.topology)
+            rollout = partial(self._rollout_vectorized, envs)
+            close_simulation = envs.close
+        else:
+            sim = SumoSimulator(
+                self.config['sumo']['config_file'],
+                self.config,
+                step_length=self.config['sumo']['step_length'],
+                gui=False,
+                topology=self.topology,
+                observed_junctions=[self.junction_id]
+            )
+            rollout = partial(self._rollout, sim)
+            close_simulation = sim.close
         
         print(f"✓ Simulation started for {self.junction_id[:20]}")
+        K = self.config['fdrl']['K']
         
         # Training epochs - simulation continues throughout
         for epoch in range(self.config['fdrl']['epochs']):
             # Receive global model weights
-            data_size_bytes = self.socket.recv(8)
-            if not data_size_bytes:
+            data_size_bytes = recv_exact(self.socket, 8)
+            if data_size_bytes is None:
                 break
             
             data_size = int.from_bytes(data_size_bytes, 'big')
-            received_data = b""
-            while len(received_data) < data_size:
-                received_data += self.socket.recv(4096)
             
-            global_weights = pickle.loads(received_data)
-            global_weights = {k: v.to(self.fabric.device) for k, v in global_weights.items()}
+            if data_size == 0:
+                # Empty frame: weights are already in shared memory
+                global_weights = self.shared_weights
+            else:
+                payload = recv_exact(self.socket, data_size, self._broadcast_buf)
+                if payload is None:
+                    break
+                global_weights = decode_weights(payload)
+            global_weights = global_weights.to(self.fabric.device)
             
-            # Update local model
-            self.agent.actor.load_state_dict(global_weights)
-            self.agent.actor_old.load_state_dict(global_weights)
+            # Update local model (in-place copies: no aliasing of shared memory)
+            copy_into_parameters(global_weights, self.agent.actor.parameters())
             
             # Local training for K steps
-            cumulative_reward = 0
-            steps_completed = 0
-            
-            for k_step in range(self.config['fdrl']['K']):
-                # Check if simulation still has vehicles
-                if traci.simulation.getMinExpectedNumber() == 0:
-                    print(f"  ⚠️  No more vehicles at epoch {epoch+1}, step {k_step}")
-                    break
-                
-                # Get state
-                state = sim.get_state(self.junction_id)
-                
-                # Select action
-                action, log_prob = self.select_action_with_masking(state)
-                
-                # Store experience
-                self.memory.states.append(state)
-                self.memory.actions.append(action)
-                self.memory.logprobs.append(log_prob)
-                
-                # Execute action
-                sim.set_phase(
-                    self.junction_id,
-                    action,
-                    self.config['fdrl']['yellow_time'],
-                    self.config['fdrl']['green_time']
-                )
-                
-                # Get reward
-                reward = sim.get_reward(self.junction_id)
-                self.memory.rewards.append(reward)
-                self.memory.is_terminals.append(False)
-                cumulative_reward += reward
-                steps_completed += 1
+            cumulative_reward, steps_completed = rollout(epoch)
             
             # CRITICAL: Only update if we have experiences
-            if len(self.memory.states) > 0:
+            if len(self.memory) > 0:
                 loss, actor_loss, critic_loss = self.agent.update(self.memory)
                 self.memory.clear_memory()
             else:
                 loss, actor_loss, critic_loss = 0.0, 0.0, 0.0
                 cumulative_reward = 0.0
             
-            # Send update to server
-            payload = {
-                'weights': {k: v.cpu() for k, v in self.agent.actor.state_dict().items()},
-                'log': {
-                    'cumulative_reward': cumulative_reward,
-                    'actor_loss': actor_loss,
-                    'critic_loss': critic_loss
-                }
-            }
+            # Send update to server: weights go to the shared-memory slot (float32)
+            # when co-located, otherwise as flat bfloat16 after the log header
+            with torch.no_grad():
+                flat_weights = parameters_to_vector(self.agent.actor.parameters())
             
-            data_bytes = pickle.dumps(payload)
-            self.socket.sendall(len(data_bytes).to_bytes(8, 'big'))
-            self.socket.sendall(data_bytes)
+            if self.shared_upload is not None:
+                self.shared_upload.copy_(flat_weights)
+                data_bytes = pack_update(None, cumulative_reward, actor_loss, critic_loss, steps_completed)
+            else:
+                self._send_buf.copy_(flat_weights, non_blocking=self._pinned_send)
+                if self._pinned_send:
+                    torch.cuda.synchronize(self.fabric.device)
+                data_bytes = pack_update(self._send_buf, cumulative_reward, actor_loss, critic_loss,
+                                         steps_completed, self._upload_buf)
+            send_frame(self.socket, data_bytes)
             
             if epoch % 10 == 0 or epoch == 0:
-                print(f"  Epoch {epoch+1}: R={cumulative_reward:.2f} ({steps_completed}/{self.config['fdrl']['K']} steps)")
+                print(f"  Epoch {epoch+1}: R={cumulative_reward:.2f} ({steps_completed}/{K} steps)")
         
         # Cleanup
-        sim.close()
+        close_simulation()
         self.socket.close()
         print(f"✓ Client {self.junction_id[:20]} training complete")
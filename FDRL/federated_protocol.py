@@ -0,0 +1,145 @@
+"""
+Wire Format for Federated Client/Server Communication
+Model weights travel as one flat bfloat16 vector instead of a pickled state_dict
+"""
+
+import socket
+import struct
+import numpy as np
+import torch
+
+# Client log header: cumulative_reward, actor_loss, critic_loss, steps
+LOG_STRUCT = struct.Struct('<3dI')
+
+# Client handshake header: state_dim, action_dim, junction_id byte length
+HELLO_STRUCT = struct.Struct('<IIH')
+
+# Kernel send/receive buffer size for federated sockets
+SOCKET_BUFFER_SIZE = 4 << 20
+
+# Weights are sent in bfloat16 (half the bytes of float32, same exponent range)
+WIRE_DTYPE = torch.bfloat16
+WIRE_ITEMSIZE = torch.finfo(WIRE_DTYPE).bits // 8
+
+def encode_weights(weights, out=None, offset=0):
+    """
+    Flat CPU weight tensor -> raw bfloat16 bytes. With out (a bytearray),
+    writes in place at offset and returns out instead of new bytes.
+    """
+    # NumPy has no bfloat16, so move the bits through an int16 view
+    bits = weights.to(WIRE_DTYPE).view(torch.int16).numpy()
+    if out is None:
+        return bits.tobytes()
+    
+    np.copyto(np.frombuffer(out, dtype=np.int16, count=bits.size, offset=offset), bits)
+    return out
+
+def decode_weights(data, offset=0):
+    """
+    Raw bfloat16 bytes -> flat float32 tensor. A writable buffer (e.g. a
+    reused bytearray) is read without copying; .float() materializes the result.
+    """
+    bits = np.frombuffer(data, dtype=np.int16, offset=offset)
+    if not bits.flags.writeable:
+        bits = bits.copy()  # torch.from_numpy needs writable memory (bytes input)
+    return torch.from_numpy(bits).view(WIRE_DTYPE).float()
+
+def copy_into_parameters(weights, parameters):
+    """
+    Copies a flat weight vector into parameters in place. Unlike
+    vector_to_parameters, the parameters never alias the source vector.
+    """
+    offset = 0
+    for param in parameters:
+        numel = param.numel()
+        param.data.copy_(weights[offset:offset + numel].view_as(param))
+        offset += numel
+
+def update_size(n_params):
+    """Byte size of a pack_update payload for n_params weights."""
+    return LOG_STRUCT.size + n_params * WIRE_ITEMSIZE
+
+def pack_update(weights, cumulative_reward, actor_loss, critic_loss, steps, out=None):
+    """
+    Client -> server payload: fixed-size log header followed by the
+    flattened actor parameters (CPU tensor) in wire precision.
+    With out (a bytearray of update_size bytes), packs in place.
+    weights=None sends only the header (weights travel via shared memory).
+    """
+    if weights is None:
+        return LOG_STRUCT.pack(cumulative_reward, actor_loss, critic_loss, steps)
+    if out is None:
+        header = LOG_STRUCT.pack(cumulative_reward, actor_loss, critic_loss, steps)
+        return header + encode_weights(weights)
+    
+    LOG_STRUCT.pack_into(out, 0, cumulative_reward, actor_loss, critic_loss, steps)
+    return encode_weights(weights, out, LOG_STRUCT.size)
+
+def unpack_update(data):
+    """
+    Inverse of pack_update. Returns (flat float32 weights, log dict);
+    weights is None for a header-only update.
+    """
+    cumulative_reward, actor_loss, critic_loss, steps = LOG_STRUCT.unpack_from(data)
+    weights = decode_weights(data, offset=LOG_STRUCT.size) if len(data) > LOG_STRUCT.size else None
+    
+    log = {
+        'cumulative_reward': cumulative_reward,
+        'actor_loss': actor_loss,
+        'critic_loss': critic_loss,
+        'steps': steps
+    }
+    return weights, log
+
+def pack_hello(junction_id, state_dim, action_dim):
+    """Client -> server handshake: fixed header followed by the UTF-8 junction ID."""
+    jid_bytes = junction_id.encode('utf-8')
+    return HELLO_STRUCT.pack(state_dim, action_dim, len(jid_bytes)) + jid_bytes
+
+def recv_hello(sock):
+    """Reads one handshake from sock. Returns the client metadata dict."""
+    state_dim, action_dim, jid_len = HELLO_STRUCT.unpack(recv_exact(sock, HELLO_STRUCT.size))
+    
+    return {
+        'junction_id': recv_exact(sock, jid_len).decode('utf-8'),
+        'state_dim': state_dim,
+        'action_dim': action_dim
+    }
+
+def configure_socket(sock):
+    """Disables Nagle and enlarges kernel buffers (call before connect or right after accept)."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+def send_frame(sock, payload):
+    """Sends the 8-byte length prefix and payload in one gathered write."""
+    prefix = len(payload).to_bytes(8, 'big')
+    sent = sock.sendmsg([prefix, payload])
+    
+    # Finish a partial write (large payloads can exceed the socket buffer)
+    if sent < len(prefix):
+        sock.sendall(prefix[sent:])
+        sent = len(prefix)
+    if sent < len(prefix) + len(payload):
+        sock.sendall(memoryview(payload)[sent - len(prefix):])
+
+def recv_exact(sock, size, out=None):
+    """
+    Receives exactly size bytes straight into a preallocated bytearray
+    (out is reused when it has exactly that size).
+    Returns None if the peer closed the connection before sending anything.
+    """
+    buf = out if out is not None and len(out) == size else bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionError(f"Connection closed after {received}/{size} bytes")
+        received += n
+    
+    return buf
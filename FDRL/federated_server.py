@@ -4,20 +4,27 @@ Aggregates model updates from multiple junction clients
 """
 
 import socket
-import pickle
+import queue
+import threading
 import torch
 import json
 import numpy as np
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ppo_agent import PPOAgent
+from federated_protocol import encode_weights, unpack_update, recv_hello, send_frame, recv_exact, configure_socket, update_size, WIRE_DTYPE, WIRE_ITEMSIZE
 from lightning.fabric import Fabric
 import os
 
 class FederatedServer:
-    def __init__(self, config, ready_event=None):
+    def __init__(self, config, ready_event=None, shared_weights=None, shared_uploads=None):
         self.config = config
         self.ready_event = ready_event
         
+        # Flat global weights and per-client upload rows in shared memory
+        # (set when clients are co-located; rows follow controlled_junctions)
+        self.shared_weights = shared_weights
+        self.shared_uploads = shared_uploads
+        
         # Initialize Fabric for distributed training
         self.fabric = Fabric(accelerator="auto", devices=1)
         self.fabric.launch()
@@ -41,12 +48,88 @@ class FederatedServer:
         # Initialize global agent
         self.global_agent = PPOAgent(self.state_dim, self.action_dim, config, fabric=self.fabric)
         self.alpha = config['fdrl']['alpha']
+        self.epochs = config['fdrl']['epochs']
+        
+        # Fixed topology: resolve the parameter list and split sizes once
+        self._params = list(self.global_agent.actor.parameters())
+        self._param_numels = [p.numel() for p in self._params]
+        n_params = sum(self._param_numels)
+        
+        # Persistent on-device running sum of client weights (streaming FedAvg)
+        self._agg_sum = torch.zeros(n_params, device=self.fabric.device)
+        
+        # Flattened global weights on device, and their host mirror in wire
+        # precision (pinned on GPU so the D2H copy can run asynchronously)
+        self._flat_global = torch.empty(n_params, device=self.fabric.device)
+        self._pinned_host = self.fabric.device.type == 'cuda'
+        self._flat_host = torch.empty(n_params, dtype=WIRE_DTYPE, pin_memory=self._pinned_host)
+        
+        # Reusable wire buffers (broadcast payload, one upload slot per client)
+        self._broadcast_buf = bytearray(n_params * WIRE_ITEMSIZE)
+        self._recv_bufs = [bytearray(update_size(n_params)) for _ in range(self.num_clients)]
+        
+        # Per-client log slots; each I/O thread writes only its own index
+        self._client_logs = [None] * self.num_clients
         self.log_file = config['system']['log_file']
-        self.logs = []
         
         self.client_sockets = []
         self.client_names = []
+        self._upload_rows = []
         self.device = self.fabric.device
+        
+        # Socket I/O threads (one per client; never touch global_agent)
+        self._io_pool = ThreadPoolExecutor(max_workers=max(8, self.num_clients))
+        
+        # Background writer for epoch logs and checkpoints (None stops it)
+        self._write_queue = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._writer_worker, daemon=True)
+        self._writer_thread.start()
+    
+    def _writer_worker(self):
+        """
+        Writes queued items to disk off the training loop: epoch log records
+        are appended to the JSON Lines log, state_dicts become the checkpoint.
+        """
+        with open(self.log_file, 'w') as log_f:
+            while True:
+                item = self._write_queue.get()
+                if item is None:
+                    break
+                
+                kind, payload = item
+                if kind == 'log':
+                    log_f.write(json.dumps(payload) + '\n')
+                    log_f.flush()
+                else:
+                    os.makedirs('saved_models', exist_ok=True)
+                    torch.save(payload, 'saved_models/universal_model.pth')
+    
+    def _save_checkpoint(self):
+        """Queues a CPU snapshot of the global actor (copied: training keeps mutating it)."""
+        state_dict = {k: v.to('cpu', copy=True) for k, v in self.global_agent.actor.state_dict().items()}
+        self._write_queue.put(('checkpoint', state_dict))
+    
+    def _recv_update(self, client_idx):
+        """
+        Receives and decodes one framed client update. The log goes into the
+        client's own slot (no locking); the flat weights are returned, or
+        None if the client took no training steps this epoch.
+        """
+        client_socket = self.client_sockets[client_idx]
+        data_size_bytes = recv_exact(client_socket, 8)
+        if data_size_bytes is None:
+            raise ConnectionError("Client disconnected before sending its update")
+        
+        data_size = int.from_bytes(data_size_bytes, 'big')
+        payload = recv_exact(client_socket, data_size, self._recv_bufs[client_idx])
+        if payload is None:
+            raise ConnectionError("Client disconnected before sending its update")
+        weights, log = unpack_update(payload)
+        if weights is None:
+            # Header-only update: the client wrote its weights to shared memory
+            weights = self.shared_uploads[self._upload_rows[client_idx]]
+        self._client_logs[client_idx] = log
+        return weights if log['steps'] > 0 else None
     
     def start(self):
         # Setup server socket
@@ -64,9 +147,17 @@ class FederatedServer:
         # Accept client connections
         for i in range(self.num_clients):
             client_socket, addr = server_socket.accept()
-            meta_data = pickle.loads(client_socket.recv(4096))
+            configure_socket(client_socket)
+            meta_data = recv_hello(client_socket)
             self.client_sockets.append(client_socket)
             self.client_names.append(meta_data['junction_id'])
+            if self.shared_uploads is not None:
+                # Shared upload row i belongs to controlled_junctions[i]
+                controlled_junctions = self.config['system']['controlled_junctions']
+                if meta_data['junction_id'] not in controlled_junctions:
+                    raise ValueError(f"Client junction {meta_data['junction_id']} has no shared upload row "
+                                     f"(not in system.controlled_junctions)")
+                self._upload_rows.append(controlled_junctions.index(meta_data['junction_id']))
             print(f"✓ Client {i+1}/{self.num_clients}: {meta_data['junction_id'][:30]}")
         
         print(f"\n{'='*60}")
@@ -74,76 +165,75 @@ class FederatedServer:
         print(f"{'='*60}\n")
         
         # Training loop
-        for epoch in range(self.config['fdrl']['epochs']):
-            # Broadcast global weights to all clients
-            global_weights = self.global_agent.actor.state_dict()
+        for epoch in range(self.epochs):
+            # Broadcast global weights to all clients (one flat vector, built once)
+            with torch.no_grad():
+                global_weights = torch.cat([p.view(-1) for p in self._params], out=self._flat_global)
             
-            for client_socket in self.client_sockets:
-                # Send weights (move to CPU for serialization)
-                data = pickle.dumps({k: v.cpu() for k, v in global_weights.items()})
-                client_socket.sendall(len(data).to_bytes(8, 'big'))
-                client_socket.sendall(data)
+            if self.shared_weights is not None:
+                # Write once into shared memory; clients only get an empty frame
+                self.shared_weights.copy_(global_weights)
+                data = b""
+            else:
+                self._flat_host.copy_(global_weights, non_blocking=self._pinned_host)
+                if self._pinned_host:
+                    torch.cuda.synchronize(self.fabric.device)
+                data = encode_weights(self._flat_host, self._broadcast_buf)
             
-            # Collect client updates
-            client_weights = []
-            epoch_rewards = []
-            epoch_actor_losses = []
-            epoch_critic_losses = []
+            # Send to all clients concurrently
+            list(self._io_pool.map(lambda client_socket: send_frame(client_socket, data), self.client_sockets))
             
-            for i, client_socket in enumerate(self.client_sockets):
-                data_size = int.from_bytes(client_socket.recv(8), 'big')
-                received_data = b""
-                while len(received_data) < data_size:
-                    received_data += client_socket.recv(4096)
-                
-                payload = pickle.loads(received_data)
-                client_weights.append(payload['weights'])
-                epoch_rewards.append(payload['log']['cumulative_reward'])
-                epoch_actor_losses.append(payload['log']['actor_loss'])
-                epoch_critic_losses.append(payload['log']['critic_loss'])
+            # Collect client updates concurrently, summing each one as soon as
+            # it arrives so the reduction overlaps with slower clients
+            futures = [self._io_pool.submit(self._recv_update, i) for i in range(self.num_clients)]
             
-            # Aggregate client weights (FedAvg)
-            aggregated_weights = OrderedDict()
-            for key in client_weights[0].keys():
-                stacked = torch.stack([w[key].to(self.device) for w in client_weights])
-                aggregated_weights[key] = torch.mean(stacked, dim=0)
+            # (clients that took no steps just echo the global weights: skipped)
+            num_trained = 0
+            with torch.no_grad():
+                self._agg_sum.zero_()
+                for future in as_completed(futures):
+                    weights = future.result()
+                    if weights is not None:
+                        self._agg_sum.add_(weights.to(self.device))
+                        num_trained += 1
             
-            # Update global model with momentum
-            current_weights = self.global_agent.actor.state_dict()
-            for key in current_weights.keys():
-                current_weights[key] = ((1 - self.alpha) * aggregated_weights[key] +
-                                       self.alpha * current_weights[key])
+            epoch_rewards = [log['cumulative_reward'] for log in self._client_logs]
+            epoch_actor_losses = [log['actor_loss'] for log in self._client_logs]
+            epoch_critic_losses = [log['critic_loss'] for log in self._client_logs]
             
-            self.global_agent.actor.load_state_dict(current_weights)
+            if num_trained > 0:
+                with torch.no_grad():
+                    # Update global model with momentum, in place on device (foreach kernels):
+                    # global = alpha * global + (1 - alpha) * mean(trained client weights)
+                    aggregated = [w.view_as(p) for w, p in zip(self._agg_sum.split(self._param_numels), self._params)]
+                    torch._foreach_mul_(self._params, self.alpha)
+                    torch._foreach_add_(self._params, aggregated, alpha=(1 - self.alpha) / num_trained)
             
             # Logging
             avg_reward = np.mean(epoch_rewards)
             avg_actor_loss = np.mean(epoch_actor_losses)
             avg_critic_loss = np.mean(epoch_critic_losses)
             
-            self.logs.append({
+            self._write_queue.put(('log', {
                 'epoch': epoch + 1,
                 'cumulative_reward': float(avg_reward),
                 'actor_loss': float(avg_actor_loss),
                 'critic_loss': float(avg_critic_loss)
-            })
+            }))
             
             if epoch % 10 == 0 or epoch == 0:
-                print(f"Epoch {epoch+1}/{self.config['fdrl']['epochs']}: "
+                print(f"Epoch {epoch+1}/{self.epochs}: "
                       f"R={avg_reward:.2f}, AL={avg_actor_loss:.4f}, CL={avg_critic_loss:.4f}")
             
             # Save checkpoints
             if (epoch + 1) % 50 == 0:
-                os.makedirs('saved_models', exist_ok=True)
-                torch.save(self.global_agent.actor.state_dict(), 'saved_models/universal_model.pth')
-                with open(self.log_file, 'w') as f:
-                    json.dump(self.logs, f, indent=2)
-                print(f"  → Checkpoint saved (epoch {epoch+1})")
+                self._save_checkpoint()
+                print(f"  → Checkpoint queued (epoch {epoch+1})")
         
-        # Save final model
-        torch.save(self.global_agent.actor.state_dict(), 'saved_models/universal_model.pth')
-        with open(self.log_file, 'w') as f:
-            json.dump(self.logs, f, indent=2)
+        # Save final model and wait for all pending writes
+        self._save_checkpoint()
+        self._write_queue.put(None)
+        self._writer_thread.join()
         
         print(f"\n{'='*60}")
         print("Training complete!")
@@ -152,6 +242,7 @@ class FederatedServer:
         print(f"{'='*60}\n")
         
         # Cleanup
+        self._io_pool.shutdown()
         for client_socket in self.client_sockets:
             try:
                 client_socket.close()
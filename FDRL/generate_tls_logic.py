@@ -7,11 +7,13 @@ All other junctions use their default SUMO programs.
 import os
 import sys
 import yaml
-import traci
-from xml.etree.ElementTree import Element, SubElement, tostring
-from xml.dom.minidom import parseString
+from xml.etree.ElementTree import Element, ElementTree, SubElement, indent
+from collections import defaultdict
 from sumo_simulator import SumoSimulator
 
+# Green -> yellow signal translation for the phase that follows each green
+YELLOW_TABLE = bytes.maketrans(b'G', b'y')
+
 def generate_rl_tls_programs(config_path='config.yaml'):
     """
     Generates RL-controlled programs ONLY for controlled junctions.
@@ -25,7 +27,8 @@ def generate_rl_tls_programs(config_path='config.yaml'):
         config = yaml.safe_load(f)
     
     print("\nStarting temporary SUMO simulation...")
-    temp_sim = SumoSimulator(config['sumo']['config_file'], config, gui=False)
+    temp_sim = SumoSimulator(config['sumo']['config_file'], config, gui=False, observed_junctions=[])
+    traci = temp_sim.traci  # same backend (libsumo/TraCI) as the simulator
     controlled_junction_ids = config['system']['controlled_junctions']
     print(f"Controlled junctions: {len(controlled_junction_ids)}")
     
@@ -44,6 +47,17 @@ def generate_rl_tls_programs(config_path='config.yaml'):
         controlled_links = traci.trafficlight.getControlledLinks(tls_id)
         num_signals = len(controlled_links)
         
+        # Incoming edge of each signal link, resolved once per unique lane
+        lane_to_edge = {links[0][0]: None for links in controlled_links if links}
+        for lane_id in lane_to_edge:
+            lane_to_edge[lane_id] = traci.lane.getEdgeID(lane_id)
+        
+        # Signal indices turned green by each incoming road
+        green_links = defaultdict(list)
+        for link_idx, links in enumerate(controlled_links):
+            if links:
+                green_links[lane_to_edge[links[0][0]]].append(link_idx)
+        
         # Create RL program with simple phases
         tl_logic = SubElement(xml_root, 'tlLogic', {
             'id': tls_id,
@@ -54,44 +68,33 @@ def generate_rl_tls_programs(config_path='config.yaml'):
         
         # Create one phase per incoming road (simple green phases)
         for phase_idx, road in enumerate(incoming_roads):
-            # All red by default
-            state = ['r'] * num_signals
-            
-            # Find links controlled by this road and set them green
-            for link_idx, links in enumerate(controlled_links):
-                if links:
-                    from_lane = links[0][0]
-                    from_edge = traci.lane.getEdgeID(from_lane)
-                    if from_edge == road:
-                        state[link_idx] = 'G'
+            # All red by default, links controlled by this road green
+            state = bytearray(b'r' * num_signals)
+            for link_idx in green_links[road]:
+                state[link_idx] = ord('G')
             
             # Green phase
             SubElement(tl_logic, 'phase', {
                 'duration': str(config['fdrl']['green_time']),
-                'state': ''.join(state)
+                'state': state.decode('ascii')
             })
             
             # Yellow phase
-            yellow_state = ''.join(state).replace('G', 'y')
             SubElement(tl_logic, 'phase', {
                 'duration': str(config['fdrl']['yellow_time']),
-                'state': yellow_state
+                'state': state.translate(YELLOW_TABLE).decode('ascii')
             })
         
         print(f"  ✓ {tls_id}: {len(incoming_roads)} phases created")
     
     temp_sim.close()
     
-    # Save XML
-    xml_string = tostring(xml_root, 'utf-8')
-    pretty_xml = parseString(xml_string).toprettyxml(indent="  ")
-    pretty_xml = '\n'.join([line for line in pretty_xml.split('\n') if line.strip()])
-    
+    # Save XML (indented in place, written straight from the tree)
     sumo_dir = os.path.dirname(config['sumo']['config_file'])
     output_path = os.path.join(sumo_dir, "rl_traffic_lights.add.xml")
     
-    with open(output_path, 'w') as f:
-        f.write(pretty_xml)
+    indent(xml_root, space="  ")
+    ElementTree(xml_root).write(output_path, encoding='utf-8', xml_declaration=True)
     
     print(f"\n{'='*70}")
     print(f"SUCCESS: RL programs generated")
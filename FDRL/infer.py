@@ -7,13 +7,89 @@ import yaml
 import torch
 import numpy as np
 import traci
+import traci.constants as tc
 import argparse
 import json
 import os
+import multiprocessing
 from collections import defaultdict
+from functools import partial
 from sumo_simulator import SumoSimulator
 from ppo_agent import Actor
 
+# In-place NumPy versions of the Actor activations (see ppo_agent.Actor)
+NUMPY_ACTIVATIONS = {
+    'relu': lambda h: np.maximum(h, 0.0, out=h),
+    'tanh': lambda h: np.tanh(h, out=h),
+}
+
+def numpy_policy(actor, activation, batch_size):
+    """
+    Extracts an Actor's layers as NumPy (W^T, b, out) triples for batched
+    greedy inference without the PyTorch dispatcher; out is a persistent
+    (batch_size, out_features) buffer. Returns (layers, activation_fn).
+    """
+    layers = [
+        (module.weight.detach().numpy().T.copy(),
+         module.bias.detach().numpy().copy(),
+         np.empty((batch_size, module.out_features), dtype=np.float32))
+        for module in actor.network if isinstance(module, torch.nn.Linear)
+    ]
+    return layers, NUMPY_ACTIVATIONS[activation]
+
+def greedy_actions(states, policy):
+    """
+    Argmax actions of a numpy_policy for a (batch_size, state_dim) array
+    (argmax of logits == argmax of softmax).
+    """
+    layers, activation_fn = policy
+    h = states
+    for W, b, out in layers[:-1]:
+        h = np.matmul(h, W, out=out)
+        h += b
+        activation_fn(h)
+    W, b, out = layers[-1]
+    logits = np.matmul(h, W, out=out)
+    logits += b
+    return np.argmax(logits, axis=1)
+
+def cuda_graph_policy(actor, batch_size):
+    """
+    Captures the Actor's batched greedy forward as a CUDA graph over static
+    (batch_size, state_dim) input and action buffers. Returns a function
+    mapping a states array to argmax actions (a NumPy view, reused per call).
+    """
+    network = actor.network.cuda()
+    host_states = torch.zeros((batch_size, network[0].in_features)).pin_memory()
+    host_actions = torch.empty(batch_size, dtype=torch.long).pin_memory()
+    host_states_np = host_states.numpy()
+    host_actions_np = host_actions.numpy()
+    device_states = host_states.cuda()
+    
+    # inference_mode (not just no_grad): captured ops skip version/view tracking too
+    with torch.inference_mode():
+        # Warm up on a side stream before capture (cuBLAS workspace, allocator pools)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                network(device_states)
+        torch.cuda.current_stream().wait_stream(stream)
+        
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            device_actions = network(device_states).argmax(dim=1)
+    
+    def decide(states):
+        np.copyto(host_states_np, states)
+        device_states.copy_(host_states, non_blocking=True)
+        graph.replay()
+        host_actions.copy_(device_actions, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        return host_actions_np
+    
+    return decide
+
 def run_inference(config, mode, output_file, gui=False):
     """
     Main function to run the inference simulation.
@@ -23,17 +99,7 @@ def run_inference(config, mode, output_file, gui=False):
     print(f"MODE: {mode.upper()}")
     print(f"{'='*70}\n")
     
-    # Type mapping (SUMO types -> our categories)
-    type_mapping = {
-        'bus_bus': 'bus',
-        'motorcycle_motorcycle': 'motorcycle',
-        'truck_truck': 'truck',
-        'veh_passenger': 'car',
-        'passenger': 'car',
-        'DEFAULT_VEHTYPE': 'car',
-    }
-    
-    # Category grouping (your custom format)
+    # Category grouping (your custom format; SUMO types are mapped by SumoSimulator.type_mapping)
     # private = motorcycle + car
     # emergency = truck
     # public = bus
@@ -46,11 +112,14 @@ def run_inference(config, mode, output_file, gui=False):
     
     # Start simulation
     print("Starting simulation...\n")
-    sim = SumoSimulator(config['sumo']['config_file'], config, gui=gui)
     controlled_junctions = config['system']['controlled_junctions']
+    # Only RL mode reads junction states, so fixed mode subscribes to none
+    sim = SumoSimulator(config['sumo']['config_file'], config, gui=gui,
+                        observed_junctions=controlled_junctions if mode == 'rl' else [])
+    traci = sim.traci  # libsumo when headless, TraCI for sumo-gui
     
     # Load RL model if needed
-    agents = {}
+    rl_junctions = [jid for jid in controlled_junctions if jid in sim.junctions]
     if mode == 'rl':
         model_path = 'saved_models/universal_model.pth'
         if not os.path.exists(model_path):
@@ -63,11 +132,19 @@ def run_inference(config, mode, output_file, gui=False):
         action_dim = max_roads
         
         print(f"Loading FDRL model for {len(controlled_junctions)} junctions...")
+        actor = Actor(state_dim, action_dim, config)
+        actor.load_state_dict(torch.load(model_path, map_location='cpu', weights_only=True))
+        actor.eval()
+        
+        # Universal model: one policy evaluates all junctions as a batch
+        # (CUDA graph when requested and available, NumPy otherwise)
+        if config['fdrl'].get('inference_device', 'cpu') == 'cuda' and torch.cuda.is_available() and rl_junctions:
+            decide = cuda_graph_policy(actor, len(rl_junctions))
+        else:
+            decide = partial(greedy_actions, policy=numpy_policy(actor, config['model']['activation'], len(rl_junctions)))
+        states = np.empty((len(rl_junctions), state_dim), dtype=np.float32)
+        
         for jid in controlled_junctions:
-            agents[jid] = Actor(state_dim, action_dim, config)
-            agents[jid].load_state_dict(torch.load(model_path, map_location='cpu'))
-            agents[jid].eval()
-            
             try:
                 traci.trafficlight.setProgram(jid, 'rl_program')
             except traci.TraCIException:
@@ -76,38 +153,39 @@ def run_inference(config, mode, output_file, gui=False):
     
     print(f"Running simulation until all vehicles are cleared...\n")
     
-    # Data collection structures
-    all_vehicle_data = defaultdict(lambda: {'wait_times': [], 'count': 0})
+    # Data collection structures (running totals per category, no per-sample lists)
+    all_vehicle_data = defaultdict(lambda: {'wait_sum': 0.0, 'count': 0})
+    
+    # Loop constants (looked up once, not per step)
+    yellow_time = config['fdrl']['yellow_time']
+    green_time = config['fdrl']['green_time']
+    rl_num_roads = [sim.junctions[jid]['num_roads'] for jid in rl_junctions]
+    get_state_batch = sim.get_state_batch
+    set_phase = sim.set_phase
     
     # Main simulation loop - runs until all vehicles cleared
     step = 0
     max_steps = 100000  # Safety limit
-    log_interval = 100
+    log_interval = config['system'].get('inference_log_interval', 100)  # Steps between waiting-time samples
     
-    while traci.simulation.getMinExpectedNumber() > 0:
+    while sim.min_expected_vehicles() > 0:
         if step >= max_steps:
             print(f"\n⚠️  Reached maximum step limit ({max_steps})")
-            print(f"   Vehicles remaining: {traci.simulation.getMinExpectedNumber()}")
+            print(f"   Vehicles remaining: {sim.min_expected_vehicles()}")
             break
         
         # RL control logic
         if mode == 'rl':
-            for jid in controlled_junctions:
-                if jid in agents and jid in sim.junctions:
-                    state = sim.get_state(jid)
-                    state_tensor = torch.FloatTensor(state)
-                    with torch.no_grad():
-                        action_probs = agents[jid](state_tensor)
-                        action = torch.argmax(action_probs).item()
-                    actual_roads = len(sim.junctions[jid]['incoming_roads'])
-                    if action < actual_roads:
-                        sim.set_phase(jid, action,
-                                    config['fdrl']['yellow_time'],
-                                    config['fdrl']['green_time'])
+            # Decide every junction from the same snapshot (one batched forward)
+            actions = decide(get_state_batch(rl_junctions, states))
+            
+            for jid, action, actual_roads in zip(rl_junctions, actions.tolist(), rl_num_roads):
+                if action < actual_roads:
+                    set_phase(jid, action, yellow_time, green_time)
         else:
             # FIXED mode: manually advance simulation
             try:
-                traci.simulationStep()
+                sim.simulation_step()
             except traci.TraCIException as e:
                 print(f"\n⚠️  Simulation error at step {step}: {e}")
                 break
@@ -115,27 +193,26 @@ def run_inference(config, mode, output_file, gui=False):
         # Collect vehicle data periodically
         if step % log_interval == 0:
             current_time = traci.simulation.getTime()
-            vehicles_expected = traci.simulation.getMinExpectedNumber()
+            vehicles_expected = sim.min_expected_vehicles()
             all_vehicles = traci.vehicle.getIDList()
             
             print(f"Step {step:6d} | Time: {current_time:8.1f}s | "
                   f"Active: {len(all_vehicles):4d} | Remaining: {vehicles_expected:4d}")
             
-            # Collect waiting time data
+            # Collect waiting time data (one batched subscription read);
+            # types come from the simulator's departure cache
+            vehicle_results = sim.subscribe_vehicles(all_vehicles, [tc.VAR_ACCUMULATED_WAITING_TIME])
+            # (every listed vehicle is in the network this step, so no lookup can fail)
             for vid in all_vehicles:
-                try:
-                    vtype_sumo = traci.vehicle.getTypeID(vid)
-                    vtype_base = type_mapping.get(vtype_sumo, vtype_sumo)
-                    
-                    # Map to your categories
-                    vtype_category = category_mapping.get(vtype_base, vtype_base)
-                    
-                    accumulated_wait = traci.vehicle.getAccumulatedWaitingTime(vid)
-                    all_vehicle_data[vtype_category]['wait_times'].append(accumulated_wait)
-                    all_vehicle_data[vtype_category]['count'] += 1
-                    
-                except traci.TraCIException:
-                    continue
+                vtype_base = sim.vehicle_type(vid)
+                
+                # Map to your categories
+                vtype_category = category_mapping.get(vtype_base, vtype_base)
+                
+                accumulated_wait = vehicle_results[vid][tc.VAR_ACCUMULATED_WAITING_TIME]
+                category_data = all_vehicle_data[vtype_category]
+                category_data['wait_sum'] += accumulated_wait
+                category_data['count'] += 1
         
         step += 1
     
@@ -146,10 +223,10 @@ def run_inference(config, mode, output_file, gui=False):
     
     # Process each category
     for category in ['private', 'public', 'emergency']:
-        if category in all_vehicle_data and all_vehicle_data[category]['wait_times']:
-            wait_times = all_vehicle_data[category]['wait_times']
-            num_vehicles = len(wait_times)
-            avg_wait = np.mean(wait_times)
+        if category in all_vehicle_data and all_vehicle_data[category]['count']:
+            num_vehicles = all_vehicle_data[category]['count']
+            wait_sum = all_vehicle_data[category]['wait_sum']
+            avg_wait = wait_sum / num_vehicles
             
             traffic_data.append({
                 "vehicle_type": category,
@@ -158,7 +235,7 @@ def run_inference(config, mode, output_file, gui=False):
             })
             
             total_vehicles += num_vehicles
-            total_wait_time_sum += sum(wait_times)
+            total_wait_time_sum += wait_sum
         else:
             # No vehicles of this type
             traffic_data.append({
@@ -211,22 +288,34 @@ def run_inference(config, mode, output_file, gui=False):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run SUMO inference for traffic control.")
     parser.add_argument('--mode', type=str, required=True,
-                       choices=['fixed', 'rl'],
-                       help='Traffic control mode: fixed (baseline) or rl (FDRL model).')
+                       choices=['fixed', 'rl', 'all'],
+                       help='Traffic control mode: fixed (baseline), rl (FDRL model) or all (both in parallel).')
     parser.add_argument('--gui', action='store_true',
                        help='Show SUMO GUI during simulation (default: headless).')
     parser.add_argument('--output', type=str, default=None,
                        help='Output JSON file path (default: inference_results/<mode>_results.json).')
     args = parser.parse_args()
     
+    modes = ['fixed', 'rl'] if args.mode == 'all' else [args.mode]
+    if args.output is not None and len(modes) > 1:
+        parser.error("--output requires a single --mode")
+    
     with open('config.yaml', 'r') as f:
         config = yaml.safe_load(f)
     
     # Set default output path
     os.makedirs('inference_results', exist_ok=True)
     if args.output is None:
-        output_file = f'inference_results/{args.mode}_results.json'
+        output_files = [f'inference_results/{mode}_results.json' for mode in modes]
     else:
-        output_file = args.output
+        output_files = [args.output]
     
-    run_inference(config, args.mode, output_file, gui=args.gui)
+    if len(modes) == 1:
+        run_inference(config, modes[0], output_files[0], gui=args.gui)
+    else:
+        # Simulations are independent: one process (and SUMO instance) per mode
+        with multiprocessing.Pool(len(modes)) as pool:
+            pool.starmap(run_inference, [
+                (config, mode, output_file, args.gui)
+                for mode, output_file in zip(modes, output_files)
+            ])
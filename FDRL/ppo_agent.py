@@ -5,23 +5,113 @@ Supports both standalone and Lightning Fabric training
 
 import torch
 import torch.nn as nn
-from torch.distributions import Categorical
+import torch.nn.functional as F
 import numpy as np
+from typing import Tuple
+
+@torch.jit.script
+def ppo_loss(logits: torch.Tensor, state_values: torch.Tensor, old_actions: torch.Tensor,
+             old_logprobs: torch.Tensor, rewards: torch.Tensor, advantages: torch.Tensor,
+             eps_clip: float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Clipped PPO surrogate plus value loss for one minibatch in one scripted graph.
+    Advantages are normalized within the minibatch. Returns (loss, actor_loss, critic_loss).
+    """
+    action_logprobs = torch.log_softmax(logits, dim=-1).gather(1, old_actions.unsqueeze(1)).squeeze(1)
+    
+    if advantages.numel() > 1:
+        advantages_std, advantages_mean = torch.std_mean(advantages)
+        advantages = (advantages - advantages_mean) / (advantages_std + 1e-7)
+    
+    # Calculate ratio and surrogate loss
+    ratios = torch.exp(action_logprobs - old_logprobs)
+    
+    surr1 = ratios * advantages
+    surr2 = torch.clamp(ratios, 1 - eps_clip, 1 + eps_clip) * advantages
+    
+    actor_loss = -torch.min(surr1, surr2).mean()
+    critic_loss = F.mse_loss(state_values, rewards)
+    return actor_loss + 0.5 * critic_loss, actor_loss, critic_loss
 
 class Memory:
-    def __init__(self):
-        self.states = []
-        self.actions = []
-        self.logprobs = []
-        self.rewards = []
-        self.is_terminals = []
+    """
+    Rollout buffer preallocated for one epoch of K steps (one array per field).
+    Only the first len(memory) rows are valid. With pin_memory, the arrays
+    update() uploads live in page-locked memory (asynchronous GPU copies).
+    With num_envs > 1, rows are time-major: step t of env e is row t * num_envs + e.
+    """
+    def __init__(self, capacity, state_dim, pin_memory=False, num_envs=1):
+        self.num_envs = num_envs
+        self.states = torch.empty((capacity, state_dim), dtype=torch.float32, pin_memory=pin_memory).numpy()
+        self.actions = torch.empty(capacity, dtype=torch.int64, pin_memory=pin_memory).numpy()
+        self.logprobs = torch.empty(capacity, dtype=torch.float32, pin_memory=pin_memory).numpy()
+        self.returns = torch.empty(capacity, dtype=torch.float32, pin_memory=pin_memory).numpy()  # Filled by compute_returns
+        self.rewards = np.empty(capacity, dtype=np.float32)
+        self.is_terminals = np.empty(capacity, dtype=np.bool_)
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def push(self, state, action, logprob, reward, is_terminal):
+        idx = self.size
+        self.states[idx] = state
+        self.actions[idx] = action
+        self.logprobs[idx] = logprob
+        self.rewards[idx] = reward
+        self.is_terminals[idx] = is_terminal
+        self.size = idx + 1
+    
+    def push_batch(self, states, actions, logprobs, rewards, is_terminals):
+        """Stores one step of every environment (arrays of length num_envs)."""
+        start, end = self.size, self.size + self.num_envs
+        self.states[start:end] = states
+        self.actions[start:end] = actions
+        self.logprobs[start:end] = logprobs
+        self.rewards[start:end] = rewards
+        self.is_terminals[start:end] = is_terminals
+        self.size = end
+    
+    def compute_returns(self, gamma):
+        """
+        Discounted rewards-to-go of the valid rows, written right-to-left
+        into the preallocated returns array (reset at terminal steps).
+        """
+        if self.num_envs > 1:
+            return self._compute_returns_batched(gamma)
+        
+        n = self.size
+        rewards = self.rewards[:n].tolist()
+        is_terminals = self.is_terminals[:n].tolist()
+        returns = self.returns
+        
+        discounted_reward = 0.0
+        for t in range(n - 1, -1, -1):
+            if is_terminals[t]:
+                discounted_reward = 0.0
+            discounted_reward = rewards[t] + gamma * discounted_reward
+            returns[t] = discounted_reward
+        
+        return returns[:n]
+    
+    def _compute_returns_batched(self, gamma):
+        """compute_returns for time-major rows: one scan over steps, vectorized over envs."""
+        n = self.size
+        rewards = self.rewards[:n].reshape(-1, self.num_envs)
+        is_terminals = self.is_terminals[:n].reshape(-1, self.num_envs)
+        returns = self.returns[:n].reshape(-1, self.num_envs)
+        
+        discounted_reward = np.zeros(self.num_envs, dtype=np.float32)
+        for t in range(len(rewards) - 1, -1, -1):
+            discounted_reward[is_terminals[t]] = 0.0
+            discounted_reward *= gamma
+            discounted_reward += rewards[t]
+            returns[t] = discounted_reward
+        
+        return self.returns[:n]
     
     def clear_memory(self):
-        del self.states[:]
-        del self.actions[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.is_terminals[:]
+        self.size = 0
 
 class Actor(nn.Module):
     def __init__(self, state_dim, action_dim, config):
@@ -43,37 +133,36 @@ class Actor(nn.Module):
             input_dim = hidden_dim
         
         layers.append(nn.Linear(input_dim, action_dim))
-        layers.append(nn.Softmax(dim=-1))
         
         self.network = nn.Sequential(*layers)
     
     def forward(self, state):
+        """Unnormalized action scores (mask, then log_softmax/softmax as needed)."""
         return self.network(state)
 
-class Critic(nn.Module):
-    def __init__(self, state_dim, config):
-        super(Critic, self).__init__()
-        
-        hidden_layers = config['model']['hidden_layers']
-        activation = config['model']['activation']
-        
-        layers = []
-        input_dim = state_dim
-        
-        for hidden_dim in hidden_layers:
-            layers.append(nn.Linear(input_dim, hidden_dim))
-            if activation == 'relu':
-                layers.append(nn.ReLU())
-            elif activation == 'tanh':
-                layers.append(nn.Tanh())
-            input_dim = hidden_dim
+class ActorCritic(nn.Module):
+    """
+    Actor plus a value head on its last hidden layer (shared trunk: one MLP
+    pass yields both logits and state values). self.actor is a plain Actor,
+    so the federated weights and saved model keep the Actor layout; only
+    the value head stays local to each client.
+    """
+    def __init__(self, state_dim, action_dim, config):
+        super(ActorCritic, self).__init__()
         
-        layers.append(nn.Linear(input_dim, 1))
+        self.actor = Actor(state_dim, action_dim, config)
+        self.value_head = nn.Linear(self.actor.network[-1].in_features, 1)
         
-        self.network = nn.Sequential(*layers)
+        # Unregistered tuple of the actor's hidden layers (a plain tuple is not
+        # registered as a submodule, so parameters stay owned by self.actor)
+        self._trunk = tuple(self.actor.network)[:-1]
     
     def forward(self, state):
-        return self.network(state)
+        """Returns (logits, state_values) for a batch of states."""
+        hidden = state
+        for layer in self._trunk:
+            hidden = layer(hidden)
+        return self.actor.network[-1](hidden), self.value_head(hidden).squeeze(-1)
 
 class PPOAgent:
     def __init__(self, state_dim, action_dim, config, fabric=None):
@@ -81,92 +170,81 @@ class PPOAgent:
         self.gamma = config['fdrl']['gamma']
         self.eps_clip = config['fdrl']['clip_epsilon']
         self.K_epochs = 4
+        self.minibatch_size = config['fdrl'].get('minibatch_size')  # None: full batch
         
-        self.actor = Actor(state_dim, action_dim, config)
-        self.critic = Critic(state_dim, config)
-        self.actor_old = Actor(state_dim, action_dim, config)
-        self.actor_old.load_state_dict(self.actor.state_dict())
-        
-        self.actor_optimizer = torch.optim.Adam(self.actor.parameters(),
-                                               lr=config['fdrl']['actor_lr'])
-        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
-                                                lr=config['fdrl']['critic_lr'])
+        self.model = ActorCritic(state_dim, action_dim, config)
+        self.actor = self.model.actor  # Federated part (trunk + policy head)
         
-        self.MseLoss = nn.MSELoss()
+        # One optimizer; the shared trunk trains at the actor's learning rate
+        self.optimizer = torch.optim.Adam([
+            {'params': self.actor.parameters(), 'lr': config['fdrl']['actor_lr']},
+            {'params': self.model.value_head.parameters(), 'lr': config['fdrl']['critic_lr']},
+        ])
         
-        # Setup with Fabric if provided
+        # Setup with Fabric if provided (moves self.actor's parameters in place)
         if self.fabric:
-            self.actor, self.actor_optimizer = self.fabric.setup(self.actor, self.actor_optimizer)
-            self.critic, self.critic_optimizer = self.fabric.setup(self.critic, self.critic_optimizer)
-            self.actor_old = self.fabric.setup_module(self.actor_old)
+            self.model, self.optimizer = self.fabric.setup(self.model, self.optimizer)
     
     def update(self, memory):
-        # Convert to tensors
-        old_states = torch.FloatTensor(np.array(memory.states))
-        old_actions = torch.LongTensor(memory.actions)
-        old_logprobs = torch.FloatTensor(memory.logprobs)
+        # Convert to tensors (zero-copy views of the valid rows; async upload when pinned)
+        n = len(memory)
+        old_states = torch.from_numpy(memory.states[:n])
+        old_actions = torch.from_numpy(memory.actions[:n])
+        old_logprobs = torch.from_numpy(memory.logprobs[:n])
         
         if self.fabric:
-            old_states = old_states.to(self.fabric.device)
-            old_actions = old_actions.to(self.fabric.device)
-            old_logprobs = old_logprobs.to(self.fabric.device)
+            old_states = old_states.to(self.fabric.device, non_blocking=True)
+            old_actions = old_actions.to(self.fabric.device, non_blocking=True)
+            old_logprobs = old_logprobs.to(self.fabric.device, non_blocking=True)
         
         # Calculate rewards-to-go
-        rewards = []
-        discounted_reward = 0
-        for reward, is_terminal in zip(reversed(memory.rewards), reversed(memory.is_terminals)):
-            if is_terminal:
-                discounted_reward = 0
-            discounted_reward = reward + (self.gamma * discounted_reward)
-            rewards.insert(0, discounted_reward)
-        
-        rewards = torch.FloatTensor(rewards)
+        rewards = torch.from_numpy(memory.compute_returns(self.gamma))
         if self.fabric:
-            rewards = rewards.to(self.fabric.device)
+            rewards = rewards.to(self.fabric.device, non_blocking=True)
+        
+        # Normalize rewards (one std_mean reduction; in place, the returns buffer is scratch)
+        rewards_std, rewards_mean = torch.std_mean(rewards)
+        rewards.sub_(rewards_mean).div_(rewards_std + 1e-7)
         
-        # Normalize rewards
-        rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
+        # Advantages from the values before this update (fixed across epochs)
+        with torch.no_grad():
+            _, old_values = self.model(old_states)
+        advantages = rewards - old_values.float()
         
-        total_loss = 0
-        total_actor_loss = 0
-        total_critic_loss = 0
+        # Loss sums stay on device; one sync when the update is done
+        total_loss = torch.zeros((), device=rewards.device)
+        total_actor_loss = torch.zeros((), device=rewards.device)
+        total_critic_loss = torch.zeros((), device=rewards.device)
+        num_minibatches = 0
+        minibatch_size = self.minibatch_size or n
         
-        # Optimize for K epochs
+        # Optimize for K epochs of shuffled minibatches
         for _ in range(self.K_epochs):
-            # Evaluate old actions
-            action_probs = self.actor(old_states)
-            dist = Categorical(action_probs)
-            action_logprobs = dist.log_prob(old_actions)
-            state_values = self.critic(old_states).squeeze()
-            
-            # Calculate ratio and surrogate loss
-            ratios = torch.exp(action_logprobs - old_logprobs.detach())
-            advantages = rewards - state_values.detach()
-            
-            surr1 = ratios * advantages
-            surr2 = torch.clamp(ratios, 1-self.eps_clip, 1+self.eps_clip) * advantages
-            
-            actor_loss = -torch.min(surr1, surr2).mean()
-            critic_loss = self.MseLoss(state_values, rewards)
-            loss = actor_loss + 0.5 * critic_loss
-            
-            # Backprop
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
-            
-            if self.fabric:
-                self.fabric.backward(loss)
-            else:
-                loss.backward()
-            
-            self.actor_optimizer.step()
-            self.critic_optimizer.step()
-            
-            total_loss += loss.item()
-            total_actor_loss += actor_loss.item()
-            total_critic_loss += critic_loss.item()
-        
-        # Update old policy
-        self.actor_old.load_state_dict(self.actor.state_dict())
-        
-        return total_loss / self.K_epochs, total_actor_loss / self.K_epochs, total_critic_loss / self.K_epochs
+            for idx in torch.randperm(n, device=rewards.device).split(minibatch_size):
+                # Evaluate old actions
+                logits, state_values = self.model(old_states[idx])
+                
+                # Loss math in float32 even when the forward ran under mixed precision
+                loss, actor_loss, critic_loss = ppo_loss(
+                    logits.float(), state_values.float(), old_actions[idx], old_logprobs[idx],
+                    rewards[idx], advantages[idx], self.eps_clip
+                )
+                
+                # Backprop
+                self.optimizer.zero_grad()
+                
+                if self.fabric:
+                    self.fabric.backward(loss)
+                else:
+                    loss.backward()
+                
+                self.optimizer.step()
+                
+                total_loss += loss.detach()
+                total_actor_loss += actor_loss.detach()
+                total_critic_loss += critic_loss.detach()
+                num_minibatches += 1
+        
+        return (total_loss.item() / num_minibatches,
+                total_actor_loss.item() / num_minibatches,
+                total_critic_loss.item() / num_minibatches)
@@ -6,14 +6,33 @@ import os
 import sys
 import numpy as np
 import traci
+import traci.constants as tc
 import warnings
 from collections import defaultdict
 
+# libsumo runs SUMO in-process (no TraCI socket); it cannot drive sumo-gui
+try:
+    import libsumo
+except ImportError:
+    libsumo = None
+
+# Extra context radius beyond the longest incoming lane (lane end to node center)
+CONTEXT_RANGE_MARGIN = 50.0
+
 class SumoSimulator:
-    def __init__(self, config_file, config, step_length=1.0, gui=False, queue_dist=150):
+    def __init__(self, config_file, config, step_length=1.0, gui=False, queue_dist=150, seed=None,
+                 topology=None, observed_junctions=None):
+        """
+        topology: static network data from another simulator's topology()
+        (skips the discovery queries). observed_junctions: junction IDs whose
+        state/reward will be read (default: all); only these get subscriptions
+        (IDs that are not traffic-light junctions of this network are ignored).
+        """
         self.config_file = config_file
         self.step_length = step_length
         self.gui = gui
+        self.seed = seed  # SUMO random seed (None: SUMO's default)
+        self.traci = traci if gui or libsumo is None else libsumo
         self.queue_detection_distance = queue_dist
         self.priority_weights = config['priority_weights']
         
@@ -29,7 +48,42 @@ class SumoSimulator:
             'DEFAULT_VEHTYPE': 'car',
         }
         
-        self.junctions = self._get_junctions_and_phase_maps()
+        # SUMO type -> (mapped type, priority weight), filled lazily per type
+        self._sumo_type_info = {}
+        
+        # Vehicle ID -> mapped type / priority weight; a vehicle's type never
+        # changes, so it is looked up once at departure and dropped on arrival
+        self.vehicle_types = {}
+        self.vehicle_weights = {}
+        
+        if topology is None:
+            self.junctions = self._get_junctions_and_phase_maps()
+            
+            # Lane IDs of every incoming road (topology is fixed for the whole run)
+            self.road_lanes = {
+                road_id: [f"{road_id}_{i}" for i in range(self.traci.edge.getLaneNumber(road_id))]
+                for junction in self.junctions.values()
+                for road_id in junction['incoming_roads']
+            }
+            self.junction_nodes, self.node_ranges = self._get_junction_context_ranges()
+        else:
+            self.junctions = topology['junctions']
+            self.road_lanes = topology['road_lanes']
+            self.junction_nodes = topology['junction_nodes']
+            self.node_ranges = topology['node_ranges']
+        
+        # Per junction: incoming lane ID -> index of its road in incoming_roads
+        self.junction_lane_index = {
+            j_id: {
+                lane_id: road_idx
+                for road_idx, road_id in enumerate(junction['incoming_roads'])
+                for lane_id in self.road_lanes[road_id]
+            }
+            for j_id, junction in self.junctions.items()
+        }
+        if observed_junctions is None:
+            observed_junctions = self.junctions
+        self._subscribe_junction_contexts([j_id for j_id in observed_junctions if j_id in self.junctions])
         
         # Calculate MAX_ROADS for universal model (padding target)
         if self.junctions:
@@ -59,8 +113,18 @@ class SumoSimulator:
             "--no-warnings", "true",
             "--time-to-teleport", "300",  # Prevent gridlock
         ]
+        if self.seed is not None:
+            sumo_cmd += ["--seed", str(self.seed)]
         
-        traci.start(sumo_cmd)
+        self.traci.start(sumo_cmd)
+        
+        # Refreshed by every simulationStep, read without an extra query
+        self.traci.simulation.subscribe([
+            tc.VAR_TIME,
+            tc.VAR_MIN_EXPECTED_VEHICLES,
+            tc.VAR_DEPARTED_VEHICLES_IDS,
+            tc.VAR_ARRIVED_VEHICLES_IDS,
+        ])
     
     def _get_junctions_and_phase_maps(self):
         """
@@ -68,19 +132,21 @@ class SumoSimulator:
         Each junction stores its actual number of roads for padding logic.
         """
         junctions = {}
-        junction_ids = traci.trafficlight.getIDList()
+        junction_ids = self.traci.trafficlight.getIDList()
         
         for j_id in junction_ids:
-            incoming_roads = sorted(list(set([
-                traci.lane.getEdgeID(lane)
-                for lane in set(traci.trafficlight.getControlledLanes(j_id))
-            ])))
+            # One query per junction and per unique lane; link i is controlled_lanes[i]
+            controlled_lanes = self.traci.trafficlight.getControlledLanes(j_id)
+            lane_roads = {lane: self.traci.lane.getEdgeID(lane) for lane in set(controlled_lanes)}
+            link_roads = [lane_roads[lane] for lane in controlled_lanes]
+            incoming_roads = tuple(sorted(set(lane_roads.values())))
             
-            action_to_phase_map = {}
+            # Green phase index per action (road); -1 when a road has no green phase
+            action_phases = [-1] * len(incoming_roads)
             
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                logic = traci.trafficlight.getCompleteRedYellowGreenDefinition(j_id)
+                logic = self.traci.trafficlight.getCompleteRedYellowGreenDefinition(j_id)
                 
                 if not logic:
                     continue
@@ -95,8 +161,7 @@ class SumoSimulator:
                         
                         for link_idx in green_link_indices:
                             try:
-                                controlled_lanes = traci.trafficlight.getControlledLanes(j_id)
-                                incoming_road = traci.lane.getEdgeID(controlled_lanes[link_idx])
+                                incoming_road = link_roads[link_idx]
                                 
                                 if incoming_road not in green_phases:
                                     green_phases[incoming_road] = i
@@ -105,13 +170,13 @@ class SumoSimulator:
                 
                 for action_idx, road_id in enumerate(incoming_roads):
                     if road_id in green_phases:
-                        action_to_phase_map[action_idx] = green_phases[road_id]
+                        action_phases[action_idx] = green_phases[road_id]
             
             junctions[j_id] = {
                 "id": j_id,
                 "incoming_roads": incoming_roads,
                 "num_roads": len(incoming_roads),  # Store actual number
-                "action_to_phase": action_to_phase_map
+                "action_phases": tuple(action_phases)
             }
         
         return junctions
@@ -121,110 +186,102 @@ class SumoSimulator:
         Set traffic light phase.
         IMPORTANT: action_index here is UNPADDED (0 to num_roads-1)
         """
-        junction_info = self.junctions[junction_id]
-        actual_num_roads = junction_info['num_roads']
+        action_phases = self.junctions[junction_id]['action_phases']
         
         # Ignore padded actions (beyond actual roads)
-        if action_index >= actual_num_roads:
+        if action_index >= len(action_phases):
             # This is a padded action, do nothing (maintain current phase)
-            for _ in range(green_time):
-                self.simulation_step()
+            self.simulation_step(green_time)
             return
         
-        if action_index not in junction_info['action_to_phase']:
-            for _ in range(green_time):
-                self.simulation_step()
+        target_green_phase_index = action_phases[action_index]
+        if target_green_phase_index < 0:
+            self.simulation_step(green_time)
             return
         
-        target_green_phase_index = junction_info['action_to_phase'][action_index]
-        traci.trafficlight.setPhase(junction_id, target_green_phase_index)
+        self.traci.trafficlight.setPhase(junction_id, target_green_phase_index)
         
-        for _ in range(green_time):
-            self.simulation_step()
+        # Hold the chosen green for the whole decision window, whatever the
+        # program's own phase duration is, then advance it in one call
+        self.traci.trafficlight.setPhaseDuration(junction_id, green_time * self.step_length)
+        self.simulation_step(green_time)
     
-    def get_state(self, junction_id):
+    def _get_junction_context_ranges(self):
+        """
+        Nodes the incoming roads of each junction lead into, and per node a
+        context radius covering the full length of every incoming lane.
+        Returns (junction_nodes, node_ranges).
+        """
+        node_ranges = defaultdict(float)
+        junction_nodes = {}
+        
+        for j_id, junction in self.junctions.items():
+            nodes = set()
+            for road_id in junction['incoming_roads']:
+                node = self.traci.edge.getToJunction(road_id)
+                lane_length = max(self.traci.lane.getLength(lane_id) for lane_id in self.road_lanes[road_id])
+                node_ranges[node] = max(node_ranges[node], lane_length + CONTEXT_RANGE_MARGIN)
+                nodes.add(node)
+            junction_nodes[j_id] = sorted(nodes)
+        
+        return junction_nodes, dict(node_ranges)
+    
+    def _subscribe_junction_contexts(self, junction_ids):
+        """
+        One vehicle context subscription per node around the given junctions.
+        SUMO refreshes the results on every step, so state and reward read all
+        vehicles around a junction without per-vehicle queries.
+        """
+        nodes = {node for j_id in junction_ids for node in self.junction_nodes[j_id]}
+        
+        for node in nodes:
+            radius = self.node_ranges[node]
+            self.traci.junction.subscribeContext(
+                node, tc.CMD_GET_VEHICLE_VARIABLE, radius,
+                [tc.VAR_LANE_ID, tc.VAR_SPEED, tc.VAR_WAITING_TIME]
+            )
+    
+    def _junction_vehicles(self, junction_id):
+        """Subscribed variables of every vehicle around a junction (no query)."""
+        nodes = self.junction_nodes[junction_id]
+        if len(nodes) == 1:
+            return self.traci.junction.getContextSubscriptionResults(nodes[0]) or {}
+        
+        # A vehicle can be in range of several nodes; merging counts it once
+        vehicles = {}
+        for node in nodes:
+            vehicles.update(self.traci.junction.getContextSubscriptionResults(node) or {})
+        return vehicles
+    
+    def _state_from_stats(self, road_stats):
         """
         Returns PADDED state vector for universal model with PRIORITY WEIGHTS.
         State format: [queue_0, wait_0, queue_1, wait_1, ..., queue_N, wait_N]
         Padded to max_roads with zeros.
         """
-        junction_info = self.junctions[junction_id]
-        actual_roads = junction_info['incoming_roads']
-        actual_num_roads = junction_info['num_roads']
-        
         state = []
         
-        # Get actual road data
-        for road_id in actual_roads:
-            lane_count = traci.edge.getLaneNumber(road_id)
-            lanes = [f"{road_id}_{i}" for i in range(lane_count)]
-            
-            weighted_queue_length = 0.0
-            weighted_max_wait_time = 0.0
-            
-            for lane_id in lanes:
-                vehicles = traci.lane.getLastStepVehicleIDs(lane_id)
-                
-                # Calculate weighted queue (stopped vehicles)
-                for v_id in vehicles:
-                    if traci.vehicle.getSpeed(v_id) < 0.1:
-                        sumo_v_type = traci.vehicle.getTypeID(v_id)
-                        v_type = self.type_mapping.get(sumo_v_type, sumo_v_type)
-                        weight = self.priority_weights.get(v_type, 1.0)
-                        weighted_queue_length += weight
-                
-                # Find maximum weighted waiting time
-                for v_id in vehicles:
-                    sumo_v_type = traci.vehicle.getTypeID(v_id)
-                    v_type = self.type_mapping.get(sumo_v_type, sumo_v_type)
-                    weight = self.priority_weights.get(v_type, 1.0)
-                    vehicle_wait_time = traci.vehicle.getWaitingTime(v_id)
-                    weighted_wait = vehicle_wait_time * weight
-                    
-                    if weighted_wait > weighted_max_wait_time:
-                        weighted_max_wait_time = weighted_wait
-            
+        for weighted_queue, weighted_max_wait, _ in road_stats:
             # Normalize features
-            normalized_queue = min(weighted_queue_length / 20.0, 1.0)
-            normalized_wait = min(weighted_max_wait_time / 120.0, 1.0)
+            normalized_queue = min(weighted_queue / 20.0, 1.0)
+            normalized_wait = min(weighted_max_wait / 120.0, 1.0)
             
             state.extend([normalized_queue, normalized_wait])
         
         # PAD with zeros to reach universal size
-        padding_needed = self.max_roads - actual_num_roads
+        padding_needed = self.max_roads - len(road_stats)
         state.extend([0.0, 0.0] * padding_needed)
         
         return np.array(state, dtype=np.float32)
     
-    def get_reward(self, junction_id):
+    def _reward_from_stats(self, junction_id, road_stats):
         """
         Reward calculation with PRIORITY WEIGHTS.
         Only considers ACTUAL roads, ignoring padded ones.
         """
-        junction_info = self.junctions[junction_id]
-        total_weighted_queue = 0.0
-        total_weighted_waiting_time = 0.0
-        road_queues = []
-        
-        for road_id in junction_info['incoming_roads']:
-            road_queue = 0.0
-            road_wait = 0.0
-            lanes = [f"{road_id}_{i}" for i in range(traci.edge.getLaneNumber(road_id))]
-            
-            for lane_id in lanes:
-                for v_id in traci.lane.getLastStepVehicleIDs(lane_id):
-                    sumo_v_type = traci.vehicle.getTypeID(v_id)
-                    v_type = self.type_mapping.get(sumo_v_type, sumo_v_type)
-                    weight = self.priority_weights.get(v_type, 1.0)
-                    
-                    if traci.vehicle.getSpeed(v_id) < 0.1:
-                        road_queue += weight
-                    
-                    road_wait += traci.vehicle.getWaitingTime(v_id) * weight
-            
-            total_weighted_queue += road_queue
-            total_weighted_waiting_time += road_wait
-            road_queues.append(road_queue)
+        road_queues = [road_queue for road_queue, _, _ in road_stats]
+        total_weighted_queue = sum(road_queues)
+        total_weighted_waiting_time = sum(road_wait for _, _, road_wait in road_stats)
         
         # Calculate pressure (imbalance between roads)
         pressure = 0.0
@@ -239,8 +296,140 @@ class SumoSimulator:
         
         return reward
     
-    def simulation_step(self):
-        traci.simulationStep()
+    def _junction_stats(self, junction_id):
+        """
+        Single sweep over the vehicles on the junction's incoming roads.
+        Returns (weighted_queue, weighted_max_wait, weighted_total_wait) per road.
+        """
+        lane_index = self.junction_lane_index[junction_id]
+        vehicle_weights = self.vehicle_weights
+        stats = [[0.0, 0.0, 0.0] for _ in range(self.junctions[junction_id]['num_roads'])]
+        
+        for v_id, v_vars in self._junction_vehicles(junction_id).items():
+            # Context range is a radius, so skip vehicles not on an incoming lane
+            road_idx = lane_index.get(v_vars[tc.VAR_LANE_ID])
+            if road_idx is None:
+                continue
+            road_stats = stats[road_idx]
+            
+            weight = vehicle_weights[v_id]
+            
+            # Weighted queue (stopped vehicles)
+            if v_vars[tc.VAR_SPEED] < 0.1:
+                road_stats[0] += weight
+            
+            weighted_wait = v_vars[tc.VAR_WAITING_TIME] * weight
+            road_stats[2] += weighted_wait
+            if weighted_wait > road_stats[1]:
+                road_stats[1] = weighted_wait
+        
+        return stats
+    
+    def get_state(self, junction_id):
+        """Padded, priority-weighted state vector (see _state_from_stats)."""
+        return self._state_from_stats(self._junction_stats(junction_id))
+    
+    def get_state_batch(self, junction_ids, out):
+        """
+        get_state for several junctions, written into out (a preallocated
+        (len(junction_ids), 2 * max_roads) float32 array) and normalized in
+        one vectorized pass. Returns out.
+        """
+        out.fill(0.0)
+        for row, j_id in zip(out, junction_ids):
+            road_stats = self._junction_stats(j_id)
+            row[:2 * len(road_stats)] = [
+                value for weighted_queue, weighted_max_wait, _ in road_stats
+                for value in (weighted_queue, weighted_max_wait)
+            ]
+        
+        # Same normalization as _state_from_stats
+        out[:, 0::2] *= 1.0 / 20.0
+        out[:, 1::2] *= 1.0 / 120.0
+        np.minimum(out, 1.0, out=out)
+        return out
+    
+    def get_reward(self, junction_id):
+        """Priority-weighted reward over actual roads (see _reward_from_stats)."""
+        return self._reward_from_stats(junction_id, self._junction_stats(junction_id))
+    
+    def observe(self, junction_id):
+        """
+        Returns (state, reward) from ONE sweep over the junction's vehicles.
+        Equivalent to get_state + get_reward when no step happens in between,
+        e.g. reward of the last action and state for the next decision.
+        """
+        road_stats = self._junction_stats(junction_id)
+        return self._state_from_stats(road_stats), self._reward_from_stats(junction_id, road_stats)
+    
+    def topology(self):
+        """Static network data, picklable; pass as topology= to skip rediscovery."""
+        return {
+            'junctions': self.junctions,
+            'road_lanes': self.road_lanes,
+            'junction_nodes': self.junction_nodes,
+            'node_ranges': self.node_ranges,
+        }
+    
+    def min_expected_vehicles(self):
+        """Vehicles still running or waiting to depart (subscribed, no query)."""
+        return self.traci.simulation.getSubscriptionResults()[tc.VAR_MIN_EXPECTED_VEHICLES]
+    
+    def subscribe_vehicles(self, vehicle_ids, var_ids):
+        """
+        Subscribes any not-yet-subscribed vehicles to var_ids and returns the
+        subscription results of all subscribed vehicles.
+        SUMO refreshes the results on every step, so reading them costs no
+        extra round trips (one subscribe per vehicle lifetime instead).
+        """
+        results = self.traci.vehicle.getAllSubscriptionResults()
+        missing = [v_id for v_id in vehicle_ids if v_id not in results]
+        
+        if missing:
+            for v_id in missing:
+                self.traci.vehicle.subscribe(v_id, var_ids)
+            results = self.traci.vehicle.getAllSubscriptionResults()
+        
+        return results
+    
+    def _cache_vehicle(self, v_id):
+        """Looks up a vehicle's SUMO type once; caches and returns (mapped type, weight)."""
+        sumo_v_type = self.traci.vehicle.getTypeID(v_id)
+        info = self._sumo_type_info.get(sumo_v_type)
+        if info is None:
+            v_type = self.type_mapping.get(sumo_v_type, sumo_v_type)
+            info = self._sumo_type_info[sumo_v_type] = (v_type, self.priority_weights.get(v_type, 1.0))
+        
+        self.vehicle_types[v_id], self.vehicle_weights[v_id] = info
+        return info
+    
+    def vehicle_type(self, v_id):
+        """Mapped type (see type_mapping) of a vehicle, from the departure cache."""
+        return self.vehicle_types[v_id]
+    
+    def simulation_step(self, steps=1):
+        """
+        Advances the simulation by steps steps in one call. SUMO runs the
+        intermediate steps itself and accumulates departures/arrivals over
+        all of them, so the subscribed ID lists cover the whole advance.
+        """
+        if steps == 1:
+            self.traci.simulationStep()
+        else:
+            current_time = self.traci.simulation.getSubscriptionResults()[tc.VAR_TIME]
+            self.traci.simulationStep(current_time + steps * self.step_length)
+        
+        # Keep the type caches in sync with departures/arrivals (subscribed lists).
+        # A vehicle that departed and arrived within one bulk advance is already
+        # gone (SUMO no longer knows it), so it is never cached
+        results = self.traci.simulation.getSubscriptionResults()
+        arrived = set(results[tc.VAR_ARRIVED_VEHICLES_IDS])
+        for v_id in results[tc.VAR_DEPARTED_VEHICLES_IDS]:
+            if v_id not in arrived:
+                self._cache_vehicle(v_id)
+        for v_id in arrived:
+            self.vehicle_types.pop(v_id, None)
+            self.vehicle_weights.pop(v_id, None)
     
     def init_phase_timers(self, junction_ids):
         self.phase_timers = {j_id: 0 for j_id in junction_ids}
@@ -251,4 +440,4 @@ class SumoSimulator:
             self.phase_timers[j_id] += 1
     
     def close(self):
-        traci.close()
+        self.traci.close()
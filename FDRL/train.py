@@ -4,25 +4,24 @@ Spawns federated server and multiple client processes for distributed training
 """
 
 import yaml
-import multiprocessing
-import time
+import torch
+import torch.multiprocessing as multiprocessing
 import json
-import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 from federated_server import FederatedServer
 from federated_client import FederatedClient
 from sumo_simulator import SumoSimulator
+from ppo_agent import Actor
 import os
 
-def run_server(config, ready_event):
+def run_server(config, ready_event, shared_weights, shared_uploads):
     """Start federated server process."""
-    server = FederatedServer(config, ready_event)
+    server = FederatedServer(config, ready_event, shared_weights, shared_uploads)
     server.start()
 
-def run_client(junction_info, config):
-    """Start federated client process."""
-    time.sleep(3)  # Initial delay to ensure server is ready
-    client = FederatedClient(junction_info, config)
+def run_client(junction_info, config, shared_weights, shared_upload, topology):
+    """Start federated client process (launched after the server is listening)."""
+    client = FederatedClient(junction_info, config, shared_weights, shared_upload, topology)
     client.run()
 
 def save_training_plot(log_file, output_path):
@@ -30,42 +29,54 @@ def save_training_plot(log_file, output_path):
     print("\nGenerating training plot...")
     
     try:
+        # Imported here: only the parent process plots, once at the end.
+        # A bare Figure renders with Agg (no pyplot state machine, no GUI backend)
+        import matplotlib.style
+        from matplotlib.figure import Figure
+        
+        # JSON Lines: one epoch record per line, streamed straight into an
+        # (epochs, 4) array without keeping the parsed records around
         with open(log_file, 'r') as f:
-            logs = json.load(f)
+            records = (json.loads(line) for line in f if line.strip())
+            columns = np.fromiter(
+                ((log['epoch'], log['cumulative_reward'], log['actor_loss'], log['critic_loss']) for log in records),
+                dtype=np.dtype((np.float64, 4))
+            )
         
-        if not logs:
+        if not len(columns):
             print("  ✗ No training data")
             return
         
-        df = pd.DataFrame(logs)
-        epochs = df['epoch']
+        epochs, rewards, actor_losses, critic_losses = columns.T
         
         # Setup plot style
-        plt.style.use('seaborn-v0_8-whitegrid')
-        plt.rcParams['font.family'] = 'serif'
-        
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
-        
-        # Reward plot with moving average
-        reward_ma = df['cumulative_reward'].rolling(window=10, min_periods=1).mean()
-        ax1.plot(epochs, df['cumulative_reward'], color='lightblue', alpha=0.5, label='Raw')
-        ax1.plot(epochs, reward_ma, color='darkblue', linewidth=2, label='Moving Avg')
-        ax1.set_ylabel("Cumulative Reward", fontsize=12)
-        ax1.set_title("Federated RL Training Performance", fontsize=14, weight='bold')
-        ax1.legend()
-        ax1.grid(True, alpha=0.3)
-        
-        # Loss plot
-        ax2.plot(epochs, df['actor_loss'], color='orange', linewidth=1.5, label='Actor Loss')
-        ax2.plot(epochs, df['critic_loss'], color='green', linewidth=1.5, label='Critic Loss')
-        ax2.set_ylabel("Loss", fontsize=12)
-        ax2.set_xlabel("Epoch", fontsize=12)
-        ax2.legend()
-        ax2.grid(True, alpha=0.3)
-        
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
-        plt.close()
+        with matplotlib.style.context(['seaborn-v0_8-whitegrid', {'font.family': 'serif'}]):
+            fig = Figure(figsize=(10, 8))
+            ax1, ax2 = fig.subplots(2, 1, sharex=True)
+            
+            # Reward plot with moving average
+            # (window of 10, shorter over the first epochs; via one cumulative sum)
+            window = 10
+            reward_csum = np.concatenate(([0.0], np.cumsum(rewards)))
+            ends = np.arange(1, len(rewards) + 1)
+            reward_ma = (reward_csum[ends] - reward_csum[np.maximum(ends - window, 0)]) / np.minimum(ends, window)
+            ax1.plot(epochs, rewards, color='lightblue', alpha=0.5, label='Raw')
+            ax1.plot(epochs, reward_ma, color='darkblue', linewidth=2, label='Moving Avg')
+            ax1.set_ylabel("Cumulative Reward", fontsize=12)
+            ax1.set_title("Federated RL Training Performance", fontsize=14, weight='bold')
+            ax1.legend()
+            ax1.grid(True, alpha=0.3)
+            
+            # Loss plot
+            ax2.plot(epochs, actor_losses, color='orange', linewidth=1.5, label='Actor Loss')
+            ax2.plot(epochs, critic_losses, color='green', linewidth=1.5, label='Critic Loss')
+            ax2.set_ylabel("Loss", fontsize=12)
+            ax2.set_xlabel("Epoch", fontsize=12)
+            ax2.legend()
+            ax2.grid(True, alpha=0.3)
+            
+            fig.tight_layout()
+            fig.savefig(output_path, dpi=300, bbox_inches='tight')
         
         print(f"  ✓ Plot saved: {output_path}")
         
@@ -73,25 +84,41 @@ def save_training_plot(log_file, output_path):
         print(f"  ✗ Plot generation failed: {e}")
 
 if __name__ == '__main__':
+    # Children fork from a clean server process that has torch and the client
+    # stack imported once, instead of forking this (threaded) parent or
+    # re-importing everything per spawn (missing modules are skipped).
+    # Windows has no forkserver and keeps the default spawn.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('forkserver')
+        multiprocessing.set_forkserver_preload(['torch', 'numpy', 'traci', 'federated_server', 'federated_client'])
+    
     # Load configuration
     with open('config.yaml', 'r') as f:
         config = yaml.safe_load(f)
     
     print("Discovering junctions...")
-    temp_sim = SumoSimulator(config['sumo']['config_file'], config, gui=False)
+    temp_sim = SumoSimulator(config['sumo']['config_file'], config, gui=False, observed_junctions=[])
     controlled_junction_ids = config['system']['controlled_junctions']
     controlled_junctions_info = [temp_sim.junctions[j_id] for j_id in controlled_junction_ids]
+    topology = temp_sim.topology()  # Reused by every client instead of rediscovering
     temp_sim.close()
     
     print(f"Training with {len(controlled_junctions_info)} junctions\n")
     
+    # Global weights shared by the server and all local clients (one flat vector),
+    # plus one upload row per client (row i = controlled_junctions[i])
+    max_roads = config['system']['max_roads']
+    n_params = sum(p.numel() for p in Actor(2 * max_roads, max_roads, config).parameters())
+    shared_weights = torch.zeros(n_params).share_memory_()
+    shared_uploads = torch.zeros(len(controlled_junctions_info), n_params).share_memory_()
+    
     # Create server and client processes
     server_ready = multiprocessing.Event()
-    server_process = multiprocessing.Process(target=run_server, args=(config, server_ready))
+    server_process = multiprocessing.Process(target=run_server, args=(config, server_ready, shared_weights, shared_uploads))
     
     client_processes = [
-        multiprocessing.Process(target=run_client, args=(j_info, config))
-        for j_info in controlled_junctions_info
+        multiprocessing.Process(target=run_client, args=(j_info, config, shared_weights, shared_uploads[i], topology))
+        for i, j_info in enumerate(controlled_junctions_info)
     ]
     
     # Start server
@@ -100,10 +127,10 @@ if __name__ == '__main__':
     server_ready.wait(timeout=30)
     print("Server ready! Starting clients...\n")
     
-    # Start clients with staggered delays
+    # Start clients together: the server is already listening with a backlog
+    # of one slot per client, so no stagger is needed
     for p in client_processes:
         p.start()
-        time.sleep(0.5)  # Stagger client starts
     
     # Wait for training to complete
     try:
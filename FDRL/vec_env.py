@@ -0,0 +1,90 @@
+"""
+Parallel SUMO Environments for a Single Junction
+Worker processes each run their own simulation; the client steps them in lockstep
+"""
+
+import multiprocessing
+from sumo_simulator import SumoSimulator
+
+def _env_worker(conn, junction_id, config, seed, topology):
+    """Runs one SumoSimulator and serves (command, argument) requests over conn."""
+    sim = SumoSimulator(
+        config['sumo']['config_file'],
+        config,
+        step_length=config['sumo']['step_length'],
+        gui=False,
+        seed=seed,
+        topology=topology,
+        observed_junctions=[junction_id]
+    )
+    yellow_time = config['fdrl']['yellow_time']
+    green_time = config['fdrl']['green_time']
+    
+    try:
+        while True:
+            command, action = conn.recv()
+            if command == 'step':
+                sim.set_phase(junction_id, action, yellow_time, green_time)
+                state, reward = sim.observe(junction_id)
+                conn.send((state, reward, sim.min_expected_vehicles()))
+            elif command == 'state':
+                conn.send((sim.get_state(junction_id), sim.min_expected_vehicles()))
+            elif command == 'close':
+                break
+    finally:
+        sim.close()
+        conn.close()
+
+class SumoVecEnv:
+    """
+    num_envs independent simulations of the same network, each in its own
+    process (libsumo allows one simulation per process). Environment i
+    runs with SUMO seed i, so their traffic diverges. All calls are batched:
+    requests go out to every worker before any reply is read.
+    """
+    def __init__(self, num_envs, junction_id, config, topology=None):
+        self.num_envs = num_envs
+        
+        # Spawned (not forked) workers: the client already holds torch/Fabric state
+        ctx = multiprocessing.get_context('spawn')
+        self.conns = []
+        self.processes = []
+        for seed in range(num_envs):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_env_worker, args=(child_conn, junction_id, config, seed, topology))
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+    
+    def get_states(self, out):
+        """Writes every environment's state into out (num_envs, state_dim). Returns min vehicles left."""
+        for conn in self.conns:
+            conn.send(('state', None))
+        
+        min_remaining = None
+        for i, conn in enumerate(self.conns):
+            out[i], remaining = conn.recv()
+            min_remaining = remaining if min_remaining is None else min(min_remaining, remaining)
+        return min_remaining
+    
+    def step(self, actions, states_out, rewards_out):
+        """
+        Applies actions[i] to environment i and writes the resulting states
+        and rewards into the given arrays. Returns min vehicles left.
+        """
+        for conn, action in zip(self.conns, actions):
+            conn.send(('step', action))
+        
+        min_remaining = None
+        for i, conn in enumerate(self.conns):
+            states_out[i], rewards_out[i], remaining = conn.recv()
+            min_remaining = remaining if min_remaining is None else min(min_remaining, remaining)
+        return min_remaining
+    
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+        for conn, process in zip(self.conns, self.processes):
+            process.join()
+            conn.close()